@@ -101,6 +101,8 @@ impl Builder {
             seq_counter: 0,
             log_to_stdout: self.log_to_stdout,
             stdout_writer: StandardStream::stdout(ColorChoice::Auto),
+            stdout_ts_secs: i64::MIN,
+            stdout_ts: String::new(),
         };
 
         tokio::spawn(actor.run());
@@ -203,6 +205,8 @@ struct LoggerActor {
     seq_counter: u64,
     log_to_stdout: bool,
     stdout_writer: StandardStream,
+    stdout_ts_secs: i64,
+    stdout_ts: String,
 }
 
 impl LoggerActor {
@@ -251,11 +255,14 @@ impl LoggerActor {
             Level::Trace => level_spec.set_fg(Some(Color::Magenta)).set_bold(true),
         };
 
-        write!(
-            &mut self.stdout_writer,
-            "[{} ",
-            entry.timestamp.format("%Y-%m-%dT%H:%M:%SZ")
-        )?;
+        // The stdout timestamp has second resolution, so it only needs to be
+        // formatted again once the second changes.
+        let secs = entry.timestamp.timestamp();
+        if secs != self.stdout_ts_secs {
+            self.stdout_ts = entry.timestamp.format("%Y-%m-%dT%H:%M:%SZ").to_string();
+            self.stdout_ts_secs = secs;
+        }
+        write!(&mut self.stdout_writer, "[{} ", self.stdout_ts)?;
 
         self.stdout_writer.set_color(&level_spec)?;
         write!(&mut self.stdout_writer, "{:<5}", entry.level.to_string())?;
@@ -3,7 +3,7 @@
 
 use dhcproto::v6::*;
 use futures::stream::TryStreamExt;
-use log::{error, info, warn};
+use log::{debug, error, info, warn};
 use netlink_packet_route::route::{
     RouteAddress, RouteAttribute, RouteMessage, RouteProtocol, RouteScope, RouteType,
 };
@@ -22,7 +22,7 @@ use pnet::{
     util::MacAddr,
 };
 use rtnetlink::{new_connection, Error, Handle};
-use socket2::{Domain, Protocol, SockAddr, Socket, Type};
+use socket2::{Domain, Protocol, SockAddr, SockFilter, Socket, Type};
 use std::io;
 use std::net::{Ipv6Addr, SocketAddr, SocketAddrV6};
 use std::thread::sleep;
@@ -199,6 +199,62 @@ pub fn is_dhcpv6_needed(interface_name: String, ignore_ra_flag: bool) -> Option<
     sender_ipv6_address
 }
 
+/// Upper bound for a DHCPv6 message on the wire, used to size both the send
+/// and receive buffers so neither reallocates during the exchange.
+const DHCPV6_MAX_MSG_LEN: usize = 1500;
+const DHCPV6_ADVERTISE: u8 = 2;
+const DHCPV6_REPLY: u8 = 7;
+const OPTION_CLIENTID: u16 = 1;
+const OPTION_SERVERID: u16 = 2;
+
+const IANA_ID: u32 = 123;
+const IAPD_ID: u32 = 456;
+const IA_T1: u32 = 3600;
+const IA_T2: u32 = 7200;
+const IAADDR_PREFERRED_LIFETIME: u32 = 3000;
+const IAADDR_VALID_LIFETIME: u32 = 5000;
+
+/// Fixed header fields and identifiers of a received DHCPv6 message, borrowed
+/// from the receive buffer without decoding the full option tree.
+#[derive(Debug, PartialEq)]
+struct Dhcpv6Peek<'a> {
+    msg_type: u8,
+    xid: [u8; 3],
+    client_id: Option<&'a [u8]>,
+    server_id: Option<&'a [u8]>,
+}
+
+/// Walks the top-level option TLVs of a DHCPv6 message. Returns `None` if the
+/// message is truncated or an option overruns the buffer.
+fn peek_dhcpv6(data: &[u8]) -> Option<Dhcpv6Peek<'_>> {
+    if data.len() < 4 {
+        return None;
+    }
+
+    let mut peek = Dhcpv6Peek {
+        msg_type: data[0],
+        xid: [data[1], data[2], data[3]],
+        client_id: None,
+        server_id: None,
+    };
+
+    let mut off = 4;
+    while off < data.len() {
+        let header = data.get(off..off + 4)?;
+        let code = u16::from_be_bytes([header[0], header[1]]);
+        let len = u16::from_be_bytes([header[2], header[3]]) as usize;
+        let value = data.get(off + 4..off + 4 + len)?;
+        match code {
+            OPTION_CLIENTID => peek.client_id = Some(value),
+            OPTION_SERVERID => peek.server_id = Some(value),
+            _ => {}
+        }
+        off += 4 + len;
+    }
+
+    Some(peek)
+}
+
 #[derive(Debug)]
 pub struct PrefixInfo {
     pub prefix: Ipv6Addr,
@@ -212,6 +268,113 @@ pub struct Dhcpv6Result {
     pub ntp_servers: Vec<Ipv6Addr>,
 }
 
+/// Builds the IA_NA option sent in Solicit and Request, asking for `addr`.
+fn iana_option(addr: Ipv6Addr) -> DhcpOption {
+    let mut opts = DhcpOptions::default();
+    opts.insert(DhcpOption::IAAddr(IAAddr {
+        addr,
+        preferred_life: IAADDR_PREFERRED_LIFETIME,
+        valid_life: IAADDR_VALID_LIFETIME,
+        opts: DhcpOptions::default(),
+    }));
+
+    DhcpOption::IANA(IANA {
+        id: IANA_ID,
+        t1: IA_T1,
+        t2: IA_T2,
+        opts,
+    })
+}
+
+/// Builds the IA_PD option sent in Solicit and Request, carrying `prefix`.
+fn iapd_option(prefix: IAPrefix) -> DhcpOption {
+    let mut opts = DhcpOptions::default();
+    opts.insert(DhcpOption::IAPrefix(prefix));
+
+    DhcpOption::IAPD(IAPD {
+        id: IAPD_ID,
+        t1: IA_T1,
+        t2: IA_T2,
+        opts,
+    })
+}
+
+/// Returns the address from the IA_NA and the prefix from the IA_PD option of
+/// `msg`, if present.
+fn ia_leases(msg: &Message) -> (Option<&IAAddr>, Option<&IAPrefix>) {
+    let opts = msg.opts();
+    let ia_addr = match opts.get(OptionCode::IANA) {
+        Some(DhcpOption::IANA(iana)) => match iana.opts.get(OptionCode::IAAddr) {
+            Some(DhcpOption::IAAddr(ia_a)) => Some(ia_a),
+            _ => None,
+        },
+        _ => None,
+    };
+    let ia_pd = match opts.get(OptionCode::IAPD) {
+        Some(DhcpOption::IAPD(iapd)) => match iapd.opts.get(OptionCode::IAPrefix) {
+            Some(DhcpOption::IAPrefix(iaprefix)) => Some(iaprefix),
+            _ => None,
+        },
+        _ => None,
+    };
+    (ia_addr, ia_pd)
+}
+
+/// Builds the Request answering `advertise`, asking for the offered address
+/// and delegated prefix from the advertising server.
+fn build_request(advertise: &Message, xid: [u8; 3], client_id: &[u8]) -> Message {
+    let serverid = match advertise.opts().get(OptionCode::ServerId) {
+        Some(DhcpOption::ServerId(duid)) => Some(duid),
+        _ => None,
+    };
+    let (ia_addr, ia_pd) = ia_leases(advertise);
+
+    let mut request_msg = Message::new(MessageType::Request);
+    request_msg.set_xid(xid);
+    request_msg
+        .opts_mut()
+        .insert(DhcpOption::ClientId(client_id.to_vec()));
+    request_msg.opts_mut().insert(DhcpOption::ElapsedTime(0));
+    if let Some(duid) = serverid {
+        request_msg
+            .opts_mut()
+            .insert(DhcpOption::ServerId(duid.clone()));
+    } else {
+        warn!("Server ID was not found or not a ServerId type.");
+    }
+
+    if let Some(ia_a) = ia_addr {
+        request_msg.opts_mut().insert(iana_option(ia_a.addr));
+    } else {
+        warn!("No IP was found in Advertise message");
+    }
+
+    if let Some(iaprefix) = ia_pd {
+        request_msg.opts_mut().insert(iapd_option(iaprefix.clone()));
+    }
+
+    // Pass through ORO again to ensure we get NTP in Reply
+    let mut oro = ORO { opts: Vec::new() };
+    oro.opts.push(OptionCode::NtpServer); // Option 56 (RFC 5908 NTP)
+    request_msg.opts_mut().insert(DhcpOption::ORO(oro));
+
+    request_msg
+}
+
+/// Encodes `msg` into `buf`, reusing its allocation, and sends it to `dest`.
+async fn send_message(
+    socket: &UdpSocket,
+    buf: &mut Vec<u8>,
+    msg: &Message,
+    dest: SocketAddr,
+) -> Result<(), Box<dyn std::error::Error + Send + Sync>> {
+    buf.clear();
+    msg.encode(&mut Encoder::new(buf))?;
+    socket.send_to(buf, dest).await?;
+    debug!("Sent DHCPv6 {:?} ({} bytes)", msg.msg_type(), buf.len());
+    Ok(())
+}
+
 pub async fn run_dhcpv6_client(
     interface_name: String,
 ) -> Result<Dhcpv6Result, Box<dyn std::error::Error + Send + Sync>> {
@@ -220,8 +383,6 @@ pub async fn run_dhcpv6_client(
     ];
     let random_xid: [u8; 3] = [0x12, 0x34, 0x56];
     let multicast_address = "[FF02::1:2]:547".parse::<SocketAddr>().unwrap();
-    let mut ia_addr_confirm: Option<DhcpOption> = None;
-    let mut ia_pd_confirm: Option<IAPrefix> = None;
     let mut ntp_servers: Vec<Ipv6Addr> = Vec::new();
 
     let interface_index = get_interface_index(interface_name.clone()).await?;
@@ -245,151 +406,52 @@ pub async fn run_dhcpv6_client(
 
     msg.opts_mut().insert(DhcpOption::ORO(oro));
 
-    let ia_addr_instance = IAAddr {
-        addr: Ipv6Addr::new(0, 0, 0, 0, 0, 0, 0, 0),
-        preferred_life: 3000,
-        valid_life: 5000,
-        opts: DhcpOptions::default(),
-    };
-
-    let mut iana_opts = DhcpOptions::default();
-    iana_opts.insert(DhcpOption::IAAddr(ia_addr_instance));
-
-    let iana_instance = IANA {
-        id: 123,
-        t1: 3600,
-        t2: 7200,
-        opts: iana_opts,
-    };
-
-    msg.opts_mut().insert(DhcpOption::IANA(iana_instance));
+    msg.opts_mut().insert(iana_option(Ipv6Addr::UNSPECIFIED));
 
     // Request Prefix Delegation
-    let iaprefix_instance = IAPrefix {
+    msg.opts_mut().insert(iapd_option(IAPrefix {
         preferred_lifetime: 0,
         prefix_len: 80,
         opts: DhcpOptions::default(),
         valid_lifetime: 0,
-        prefix_ip: Ipv6Addr::new(0, 0, 0, 0, 0, 0, 0, 0),
-    };
+        prefix_ip: Ipv6Addr::UNSPECIFIED,
+    }));
 
-    let mut iapd_opts = DhcpOptions::default();
-    iapd_opts.insert(DhcpOption::IAPrefix(iaprefix_instance));
+    let mut buf = Vec::with_capacity(DHCPV6_MAX_MSG_LEN);
+    send_message(&socket, &mut buf, &msg, multicast_address).await?;
 
-    let iapd_instance = IAPD {
-        id: 456,
-        t1: 3600,
-        t2: 7200,
-        opts: iapd_opts,
-    };
-
-    msg.opts_mut().insert(DhcpOption::IAPD(iapd_instance));
+    let mut recv_buf = [0; DHCPV6_MAX_MSG_LEN];
+    let (ia_addr_confirm, ia_pd_confirm) = loop {
+        let (size, _) = socket.recv_from(&mut recv_buf).await?;
 
-    let mut buf = Vec::new();
-    let mut encoder = Encoder::new(&mut buf);
-    msg.encode(&mut encoder)?;
-    socket.send_to(&buf, multicast_address).await?;
+        // Discard anything that is not an Advertise/Reply for our transaction
+        // before paying for a full decode.
+        let Some(peek) = peek_dhcpv6(&recv_buf[..size]) else {
+            continue;
+        };
+        if peek.msg_type != DHCPV6_ADVERTISE && peek.msg_type != DHCPV6_REPLY {
+            continue;
+        }
+        if peek.xid != random_xid
+            || peek.client_id != Some(chaddr.as_slice())
+            || peek.server_id.is_none()
+        {
+            warn!("Ignoring DHCPv6 message not addressed to this client");
+            continue;
+        }
 
-    let mut recv_buf = [0; 1500];
-    loop {
-        let (size, _) = socket.recv_from(&mut recv_buf).await?;
         let response = Message::decode(&mut dhcproto::v6::Decoder::new(&recv_buf[..size]))?;
-        let mut serverid: Option<&DhcpOption> = None;
-        let mut ia_addr: Option<&DhcpOption> = None;
-        let mut ia_pd: Option<&DhcpOption> = None;
 
         match response.msg_type() {
             MessageType::Advertise => {
                 info!("DHCPv6 processing in progress...");
-                if let Some(DhcpOption::IANA(iana)) = response.opts().get(OptionCode::IANA) {
-                    if let Some(ia_addr_opt) = iana.opts.get(OptionCode::IAAddr) {
-                        ia_addr = Some(ia_addr_opt);
-                    }
-                }
-                if let Some(DhcpOption::IAPD(iapd)) = response.opts().get(OptionCode::IAPD) {
-                    if let Some(iaprefix_opt) = iapd.opts.get(OptionCode::IAPrefix) {
-                        ia_pd = Some(iaprefix_opt);
-                    }
-                }
-                if let Some(server_option) = response.opts().get(OptionCode::ServerId) {
-                    serverid = Some(server_option);
-                }
+                let request_msg = build_request(&response, random_xid, &chaddr);
 
-                let mut request_msg = Message::new(MessageType::Request);
-                request_msg.set_xid(random_xid);
-                request_msg
-                    .opts_mut()
-                    .insert(DhcpOption::ClientId(chaddr.clone()));
-                request_msg.opts_mut().insert(DhcpOption::ElapsedTime(0));
-                if let Some(DhcpOption::ServerId(duid)) = serverid {
-                    request_msg
-                        .opts_mut()
-                        .insert(DhcpOption::ServerId((*duid).clone()));
-                } else {
-                    warn!("Server ID was not found or not a ServerId type.");
-                }
-
-                if let Some(DhcpOption::IAAddr(ia_a)) = ia_addr {
-                    let ia_addr_instance = IAAddr {
-                        addr: ia_a.addr,
-                        preferred_life: 3000,
-                        valid_life: 5000,
-                        opts: DhcpOptions::default(),
-                    };
-                    let mut iana_opts = DhcpOptions::default();
-                    iana_opts.insert(DhcpOption::IAAddr(ia_addr_instance));
-
-                    let iana_instance = IANA {
-                        id: 123,
-                        t1: 3600,
-                        t2: 7200,
-                        opts: iana_opts,
-                    };
-                    request_msg
-                        .opts_mut()
-                        .insert(DhcpOption::IANA(iana_instance));
-                } else {
-                    warn!("No IP was found in Advertise message");
-                }
-
-                if let Some(DhcpOption::IAPrefix(iaprefix)) = ia_pd {
-                    let iapd_instance = IAPD {
-                        id: 456,
-                        t1: 3600,
-                        t2: 7200,
-                        opts: {
-                            let mut opts = DhcpOptions::default();
-                            opts.insert(DhcpOption::IAPrefix((*iaprefix).clone()));
-                            opts
-                        },
-                    };
-                    request_msg
-                        .opts_mut()
-                        .insert(DhcpOption::IAPD(iapd_instance));
-                }
-
-                // Pass through ORO again to ensure we get NTP in Reply
-                let mut oro = ORO { opts: Vec::new() };
-                oro.opts.push(OptionCode::NtpServer); // Option 56 (RFC 5908 NTP)
-                request_msg.opts_mut().insert(DhcpOption::ORO(oro));
-
-                buf.clear();
-                request_msg.encode(&mut Encoder::new(&mut buf))?;
-                socket.send_to(&buf, multicast_address).await?;
+                send_message(&socket, &mut buf, &request_msg, multicast_address).await?;
             }
             MessageType::Reply => {
-                if let Some(DhcpOption::IANA(iana)) = response.opts().get(OptionCode::IANA) {
-                    if let Some(ia_addr_opt) = iana.opts.get(OptionCode::IAAddr) {
-                        ia_addr_confirm = Some((*ia_addr_opt).clone());
-                    }
-                }
-                if let Some(DhcpOption::IAPD(iapd)) = response.opts().get(OptionCode::IAPD) {
-                    if let Some(DhcpOption::IAPrefix(iaprefix)) =
-                        iapd.opts.get(OptionCode::IAPrefix)
-                    {
-                        ia_pd_confirm = Some((*iaprefix).clone());
-                    }
-                }
+                let (ia_addr, ia_pd) = ia_leases(&response);
+                let lease = (ia_addr.cloned(), ia_pd.cloned());
 
                 // Check for Option 56 (RFC 5908 NTP Server)
                 if let Some(DhcpOption::NtpServer(ntp_subopts)) =
@@ -410,20 +472,18 @@ pub async fn run_dhcpv6_client(
 
                 let mut confirm_msg = Message::new(MessageType::Confirm);
                 confirm_msg.set_xid(random_xid);
-                buf.clear();
-                confirm_msg.encode(&mut Encoder::new(&mut buf))?;
-                socket.send_to(&buf, multicast_address).await?;
+                send_message(&socket, &mut buf, &confirm_msg, multicast_address).await?;
 
-                break;
+                break lease;
             }
             _ => {
                 // Ignore other message types
                 continue;
             }
         }
-    }
+    };
 
-    if let Some(DhcpOption::IAAddr(ia_a)) = ia_addr_confirm {
+    if let Some(ia_a) = ia_addr_confirm {
         let (connection, handle, _) = new_connection()?;
         tokio::spawn(connection);
 
@@ -493,6 +553,7 @@ fn create_multicast_socket(
 ) -> Result<UdpSocket, Box<dyn std::error::Error + Send + Sync>> {
     let socket = Socket::new(Domain::IPV6, Type::DGRAM, Some(Protocol::UDP))?;
     socket.set_reuse_address(true)?;
+    socket.set_only_v6(true)?;
     socket.set_multicast_if_v6(interface_index)?;
     socket.join_multicast_v6(&"ff02::1:2".parse()?, interface_index)?;
     socket.bind(&SockAddr::from(SocketAddrV6::new(
@@ -502,10 +563,32 @@ fn create_multicast_socket(
         0,
     )))?;
     socket.bind_device(Some(interface_name.as_bytes()))?;
+    if let Err(e) = attach_dhcpv6_response_filter(&socket) {
+        warn!("Failed to attach DHCPv6 socket filter: {e}");
+    }
     socket.set_nonblocking(true)?;
     Ok(UdpSocket::from_std(socket.into())?)
 }
 
+/// Lets the kernel drop everything but Advertise and Reply messages before
+/// they are queued on the client socket. Filters on UDP sockets see the
+/// datagram from the UDP header, so the message type sits right after it.
+fn attach_dhcpv6_response_filter(socket: &Socket) -> io::Result<()> {
+    const UDP_HEADER_LEN: u32 = 8;
+    let load_byte = (libc::BPF_LD | libc::BPF_B | libc::BPF_ABS) as u16;
+    let jump_eq = (libc::BPF_JMP | libc::BPF_JEQ | libc::BPF_K) as u16;
+    let ret = (libc::BPF_RET | libc::BPF_K) as u16;
+
+    let filter = [
+        SockFilter::new(load_byte, 0, 0, UDP_HEADER_LEN),
+        SockFilter::new(jump_eq, 2, 0, DHCPV6_ADVERTISE.into()),
+        SockFilter::new(jump_eq, 1, 0, DHCPV6_REPLY.into()),
+        SockFilter::new(ret, 0, 0, 0),
+        SockFilter::new(ret, 0, 0, u32::MAX),
+    ];
+    socket.attach_filter(&filter)
+}
+
 pub async fn add_ipv6_route(
     handle: &Handle,
     interface_name: &str,
@@ -570,3 +653,34 @@ pub async fn set_ipv6_gateway(
 
     handle.route().add(msg).execute().await
 }
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    #[test]
+    fn test_peek_dhcpv6() {
+        let header = [DHCPV6_REPLY, 0x12, 0x34, 0x56];
+        let client_id = [0x00, 0x01, 0x00, 0x02, 0xaa, 0xbb];
+        let elapsed_time = [0x00, 0x08, 0x00, 0x02, 0x00, 0x00];
+        let server_id = [0x00, 0x02, 0x00, 0x03, 0x01, 0x02, 0x03];
+        let data = [&header[..], &client_id, &elapsed_time, &server_id].concat();
+        let peek = peek_dhcpv6(&data).unwrap();
+
+        assert_eq!(peek.msg_type, DHCPV6_REPLY);
+        assert_eq!(peek.xid, [0x12, 0x34, 0x56]);
+        assert_eq!(peek.client_id, Some(&[0xaa, 0xbb][..]));
+        assert_eq!(peek.server_id, Some(&[0x01, 0x02, 0x03][..]));
+    }
+
+    #[test]
+    fn test_peek_dhcpv6_truncated() {
+        assert!(peek_dhcpv6(&[DHCPV6_REPLY, 0x12, 0x34]).is_none());
+        // Option length runs past the end of the buffer
+        assert!(
+            peek_dhcpv6(&[DHCPV6_REPLY, 0x12, 0x34, 0x56, 0x00, 0x01, 0x00, 0x04, 0xaa]).is_none()
+        );
+        // Trailing bytes too short for an option header
+        assert!(peek_dhcpv6(&[DHCPV6_REPLY, 0x12, 0x34, 0x56, 0x00]).is_none());
+    }
+}